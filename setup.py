@@ -12,8 +12,10 @@ setup(
     },
     include_package_data=True,
     install_requires=[
-        'dataclasses',
+        'httpx',
         'ollama',
+        'orjson',
+        'pydantic',
     ],
     entry_points={
         'console_scripts': [
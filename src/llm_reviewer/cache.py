@@ -0,0 +1,71 @@
+"""On-disk cache of the LLM responses."""
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+# Bump it to invalidate all the cached responses when the way they are interpreted changes.
+CACHE_VERSION: str = '1'
+
+
+def get_default_cache_dir() -> Path:
+    """Return the directory where the responses are cached by default.
+
+    As the XDG spec requires, XDG_CACHE_HOME is ignored when it is empty or not an absolute path.
+    """
+    cache_home: Path = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache')
+    if not cache_home.is_absolute():
+        cache_home = Path.home() / '.cache'
+    return cache_home / 'llm-pr-reviewer'
+
+
+class ResponseCache:
+    """Cache of LLM responses, stored as one file per request keyed by a hash of its inputs."""
+
+    def __init__(self, cache_dir: Path, ttl_days: float = 30):
+        """Create a cache rooted at cache_dir whose entries expire after ttl_days."""
+        self.cache_dir: Path = cache_dir
+        self.ttl_seconds: float = ttl_days * 24 * 60 * 60
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """Return the key that identifies a request made of parts, for the current CACHE_VERSION."""
+        return hashlib.sha256('\0'.join((CACHE_VERSION,) + parts).encode()).hexdigest()
+
+    def _get_path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.json'
+
+    def get(self, key: str) -> str | None:
+        """Return the cached response for key, or None when missing or expired.
+
+        Expired entries are removed.
+        """
+        path: Path = self._get_path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                return None
+            return path.read_text(encoding='utf-8')
+        except OSError:
+            return None
+
+    def put(self, key: str, response: str) -> None:
+        """Store the response for key.
+
+        The file is written to a temporary location first and then moved, so readers never see partial entries.
+        """
+        tmp_path: str = ''
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(response)
+            os.replace(tmp_path, self._get_path(key))
+        except OSError as e:
+            if tmp_path:
+                Path(tmp_path).unlink(missing_ok=True)
+            print(f'Warning: could not write to the response cache: {e}', file=sys.stderr)
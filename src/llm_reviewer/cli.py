@@ -1,120 +1,273 @@
 """Entry point for the package which actually process the interation with the model."""
 
 import argparse
-import sys
+import asyncio
+import dataclasses
+import hashlib
 import json
+import sys
 import os
-import difflib
-import ollama
+import re
+import functools
+import orjson
 import subprocess
-from typing import Any
-from .prompt import (
-    get_general_expert_prompt,
-    Tokens,
+from typing import Any, TYPE_CHECKING
+from .cache import (
+    get_default_cache_dir,
+    ResponseCache,
 )
+from .prompt import get_general_expert_prompt
 from .violation import Violation
 
+# ollama, httpx and pydantic take a noticeable time to import, so they are only imported when a review is requested.
+if TYPE_CHECKING:
+    import ollama
+    import pydantic
+
 
 EXTENSIONS_TO_CHECK: tuple = ('.py', '.h', '.hh', '.hpp', '.hxx', '.c', '.cc', '.cpp', '.cxx')
+_EXTENSIONS_TO_CHECK_RE: re.Pattern = re.compile('(?:' + '|'.join(re.escape(ext) for ext in EXTENSIONS_TO_CHECK) + ')$')
+
 
+# Decodes the leading json value of a str, ignoring what follows it.
+_JSON_DECODER: json.JSONDecoder = json.JSONDecoder()
 
-def get_staged_diff(filepath: str = '') -> str:
-    """Capture the difference of files in the staging area."""
+# Matches the position right before each per-file header of a git diff.
+_DIFF_HEADER_RE: re.Pattern = re.compile(r'^(?=diff --git )', re.MULTILINE)
+# Captures the b/ file path of a per-file header of a git diff.
+_DIFF_FILEPATH_RE: re.Pattern = re.compile(r'^diff --git a/.+? b/(.+)$', re.MULTILINE)
+
+
+def run_git_command(cmd: list[str]) -> str:
+    """Run a git command and return its standard output.
+
+    The output is read as bytes and decoded only once.
+    """
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+        out, err = proc.communicate()
+    if proc.returncode:
+        print(
+            f'Error getting Git diff: {cmd} returned {proc.returncode}: {err.decode("utf-8", "replace").strip()}',
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    return out.decode('utf-8', 'replace')
+
+
+def get_staged_diff_chunks() -> list[str]:
+    """Capture the difference of the files in the staging area, one diff chunk per file."""
     # When using --staged, we only care about the files that have been added for commiting.
     # When using -W, we provide more context in the diff to bring in the entire function, which
     # makes the LLM have better context.
-    cmd: list[str] = ['git', 'diff', '--staged', '-W']
-    if filepath:
-        cmd.append(filepath)
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f'Error getting Git diff: {e}', file=sys.stderr)
-        sys.exit(1)
+    # All the files are diffed with a single git call and the output is split by file afterwards.
+    # The plain patch format with a/ and b/ prefixes is forced, regardless of the user's git configuration
+    # (colors, external diff tools, prefixes), because the file paths are extracted from the diff headers.
+    cmd: list[str] = [
+        'git',
+        'diff',
+        '--staged',
+        '-W',
+        '--no-color',
+        '--no-ext-diff',
+        '--src-prefix=a/',
+        '--dst-prefix=b/',
+    ]
+    return [x for x in _DIFF_HEADER_RE.split(run_git_command(cmd)) if x]
 
 
-def get_staged_diff_files() -> list[str]:
-    """Capture the list of files in the staging area."""
-    try:
-        result = subprocess.run(['git', 'diff', '--name-only', '--staged'], capture_output=True, text=True, check=True)
-        return result.stdout.strip().split('\n')
-    except subprocess.CalledProcessError as e:
-        print(f'Error getting Git diff: {e}', file=sys.stderr)
-        sys.exit(1)
+def get_diff_chunk_filepath(diff_chunk: str) -> str:
+    """Return the path of the file changed by a diff chunk, or an empty str when it is not found."""
+    match: re.Match | None = _DIFF_FILEPATH_RE.match(diff_chunk)
+    return match.group(1) if match else ''
+
+
+def get_diff_chunk_key(diff_chunk: str) -> str:
+    """Return a key that identifies the changes of a diff chunk regardless of the file they belong to.
+
+    Only the hunks are hashed, the file header is left out.
+    """
+    hunks_start: int = diff_chunk.find('\n@@')
+    hunks: str = diff_chunk[hunks_start:] if hunks_start != -1 else diff_chunk
+    return hashlib.blake2b(hunks.encode(), digest_size=16).hexdigest()
+
+
+def relocate_violations(violations: list[Violation], from_filepath: str, to_filepath: str) -> list[Violation]:
+    """Return copies of violations found in from_filepath that refer to to_filepath instead.
+
+    Only the file header lines of the diff are rewritten, the hunks are left untouched.
+    """
+    header_re: re.Pattern = re.compile(rf'^(--- a/|\+\+\+ b/){re.escape(from_filepath)}$', re.MULTILINE)
+    return [
+        dataclasses.replace(
+            v,
+            diff=header_re.sub(lambda m: f'{m.group(1)}{to_filepath}', v.diff),
+            a_filepath=to_filepath,
+            b_filepath=to_filepath,
+        )
+        for v in violations
+    ]
+
+
+@functools.lru_cache(maxsize=1)
+def _get_violations_adapter() -> 'pydantic.TypeAdapter':
+    """Return the adapter that decodes and validates the LLM json output straight into violations."""
+    import pydantic
+
+    return pydantic.TypeAdapter(list[Violation])
+
+
+@functools.lru_cache(maxsize=1)
+def _get_violations_json_schema() -> dict[str, Any]:
+    """Return the json schema the LLM output is constrained to."""
+    return _get_violations_adapter().json_schema()
 
 
-def call_ollama_api(
+def build_chat_request(
     diff_content: str,
     config,
-    ros_distro: str,
+    system_message: dict[str, str],
     model_name: str = 'qwen3:4b',
-    ollama_host: str = 'http://localhost:11434',
-):
-    """Call the Ollama API to get the code review."""
+) -> dict[str, Any]:
+    """Build the arguments of the Ollama chat request that reviews diff_content."""
     user_prompt: str = (
         f'Review the following code changes:\n\n```diff\n{diff_content}\n```\n'
         '\nPlease adhere strictly to the requested output format.'
     )
-    messages: list[dict[str, str]] = [
-        {'role': 'system', 'content': get_general_expert_prompt()},
-        {'role': 'user', 'content': user_prompt},
-    ]
+    return {
+        'model': model_name,
+        'messages': [
+            system_message,
+            {'role': 'user', 'content': user_prompt},
+        ],
+        'options': {'temperature': config['temperature']},
+        'think': False,
+        # A concrete schema makes the model answer with plain json, without markdown fences.
+        # It is also faster to decode than the open ended format='json' grammar.
+        'format': _get_violations_json_schema(),
+    }
+
+
+async def call_ollama_api(
+    client: 'ollama.AsyncClient',
+    chat_request: dict[str, Any],
+    semaphore: asyncio.Semaphore,
+) -> tuple[str, bool]:
+    """Call the Ollama API to get the code review.
+
+    Return the LLM output and whether the model finished it on its own, rather than being cut off.
+    """
+    # Bound the number of in-flight requests so we do not flood the server.
+    # The response is streamed and its parts are gathered as they are generated.
+    content_parts: list[str] = []
+    done: bool = False
+    done_reason: str | None = None
+    async with semaphore:
+        async for chunk in await client.chat(**chat_request, stream=True):
+            content_parts.append(chunk['message']['content'])
+            done = chunk['done']
+            done_reason = chunk.get('done_reason')
+    if done:
+        return ''.join(content_parts), done_reason == 'stop'
+    else:
+        return '', False
 
-    try:
-        client: ollama.Client = ollama.Client(host=ollama_host)
-        response = client.chat(
-            model=model_name,
-            messages=messages,
-            options={'temperature': config['temperature']},
-            think=False,
-        )
-        if response['done']:
-            return response['message']['content']
-        else:
-            return ''
-    except Exception as e:
-        print(f'Error calling the Ollama API: {e}', file=sys.stderr)
-        sys.exit(1)
+
+async def review_diff_chunk(
+    diff_chunk: str,
+    config,
+    client: 'ollama.AsyncClient',
+    system_message: dict[str, str],
+    semaphore: asyncio.Semaphore,
+    cache: ResponseCache | None = None,
+) -> list[Violation]:
+    """Request the review of a diff chunk and parse it into violations.
+
+    When a cache is given, a previous response to the very same request is reused without calling the model.
+    Only complete responses that could be parsed are stored in the cache.
+    """
+    chat_request: dict[str, Any] = build_chat_request(diff_chunk, config, system_message)
+    cache_key: str = ''
+    if cache is not None:
+        # The whole request is hashed, so any change to the prompts, options or output format is a cache miss.
+        cache_key = cache.make_key(json.dumps(chat_request, sort_keys=True))
+        cached_response: str | None = cache.get(cache_key)
+        if cached_response is not None:
+            try:
+                return await asyncio.to_thread(parse_llm_output, cached_response)
+            except ValueError:
+                pass  # Entries that can no longer be parsed are reviewed again.
+
+    llm_output, complete = await call_ollama_api(client, chat_request, semaphore)
+    # Parse in a worker thread so the event loop keeps receiving the responses of the other chunks meanwhile.
+    violations: list[Violation] = await asyncio.to_thread(parse_llm_output, llm_output)
+    if cache is not None and complete:
+        cache.put(cache_key, llm_output)
+    return violations
+
+
+async def review_diff_chunks(
+    diff_chunks: list[str],
+    config,
+    system_message: dict[str, str],
+    cache: ResponseCache | None = None,
+    ollama_host: str = 'http://localhost:11434',
+) -> list[list[Violation] | BaseException]:
+    """Request the reviews of all the diff chunks concurrently.
+
+    All the requests share the same client and its pool of keep-alive connections.
+    The result holds the violations of each diff chunk, in the order of diff_chunks.
+    Failed reviews are returned as exceptions.
+    """
+    if not diff_chunks:
+        return []
+
+    import httpx
+    import ollama
+
+    max_parallel: int = config.get('max_parallel', 4)
+    semaphore = asyncio.Semaphore(max_parallel)
+    # Keep one connection alive per concurrent request so they are reused by the following chunks.
+    limits = httpx.Limits(max_connections=max_parallel, max_keepalive_connections=max_parallel)
+    async with ollama.AsyncClient(host=ollama_host, limits=limits) as client:
+        tasks = [
+            review_diff_chunk(diff_chunk, config, client, system_message, semaphore, cache)
+            for diff_chunk in diff_chunks
+        ]
+        return await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def generate_git_diff(original_code: str, proposed_code: str, a_filepath: str, b_filepath: str) -> str:
     """Generate a git diff format str from two code blocks."""
+    import difflib
+
     diff = difflib.unified_diff(
-        original_code.splitlines(keepends=True),
-        proposed_code.splitlines(keepends=True),
+        original_code.splitlines(),
+        proposed_code.splitlines(),
         fromfile=f'a/{a_filepath}',
         tofile=f'b/{b_filepath}',
         lineterm='',  # Avoid adding the extra '\n'
     )
-    return ''.join(list(diff))
-
-
-def dict_to_violation(in_dict: dict[str, str]) -> Violation:
-    """Create a violation from a dictionary."""
-    return Violation(
-        original_code=in_dict[Tokens.ORIGINAL_CODE_TOKEN],
-        proposed_code=in_dict[Tokens.PROPOSED_CODE_TOKEN],
-        diff=in_dict[Tokens.DIFF_TOKEN],
-        explanation=in_dict[Tokens.EXPLANATION_TOKEN],
-        suggestion=in_dict[Tokens.SUGGESTION_TOKEN],
-        a_filepath=in_dict[Tokens.FROM_FILE_A_TOKEN],
-        b_filepath=in_dict[Tokens.FROM_FILE_B_TOKEN],
-    )
+    return '\n'.join(diff)
 
 
 def parse_llm_output(llm_output: str) -> list[Violation]:
-    """Parse the LLM output and return a list of violations."""
-    violations: list[Violation] = []
-    llm_output = llm_output[7:] if llm_output.startswith('```json') else llm_output
-    llm_output = llm_output[:-3] if llm_output.endswith('```') else llm_output
-    llm_output = llm_output.strip()
+    """Parse the LLM output and return a list of violations.
 
-    violations_list = json.loads(llm_output)
-    if not isinstance(violations_list, list):
-        violations_list = [violations_list]
-
-    violations = [dict_to_violation(v) for v in violations_list]
+    Any text the LLM may add after the json list is ignored.
+    """
+    try:
+        violations: list[Violation] = _get_violations_adapter().validate_json(llm_output)
+    except ValueError:
+        # Decode only the first json value and validate it on its own.
+        json_value, _ = _JSON_DECODER.raw_decode(llm_output.lstrip())
+        violations = _get_violations_adapter().validate_python(json_value)
+
+    # Only generate the diff locally when the LLM did not provide one.
+    for violation in violations:
+        if not violation.diff:
+            violation.diff = generate_git_diff(
+                violation.original_code, violation.proposed_code, violation.a_filepath, violation.b_filepath
+            )
 
     return violations
 
@@ -124,8 +277,8 @@ def load_config(config_file_path: str) -> dict:
     if not os.path.exists(config_file_path):
         print(f'Error: file not found: {config_file_path}', file=sys.stderr)
         sys.exit(1)
-    with open(config_file_path, 'r') as f:
-        return json.load(f)
+    with open(config_file_path, 'rb') as f:
+        return orjson.loads(f.read())
 
 
 def parse_args() -> dict[str, Any]:
@@ -146,10 +299,16 @@ def parse_args() -> dict[str, Any]:
         help='Make the program always return zero regardless of the review result.',
         action='store_true',
     )
+    parser.add_argument(
+        '--no-cache',
+        default=False,
+        help='Always call the LLM instead of reusing the cached responses of previous reviews.',
+        action='store_true',
+    )
     parser.add_argument(
         '--ros-distro',
         default='jazzy',
-        help='ROS distribution name.',
+        help='Ignored. Only accepted for compatibility with existing configurations.',
     )
     return parser.parse_args()
 
@@ -158,26 +317,63 @@ def main() -> None:
     """Entry point."""
     args = parse_args()
     config_file: str = args.config_file
-    ros_distro: str = args.ros_distro
     force_exit_zero: bool = args.exit_zero
+    use_cache: bool = not args.no_cache
     exit_result: int = 0
 
     config = load_config(config_file)
-
-    # Extract filenames form the diff to pass them to the parser.
-    modified_files: list[str] = get_staged_diff_files()
-    modified_files[:] = [f for f in modified_files if f.endswith(EXTENSIONS_TO_CHECK)]
+    cache: ResponseCache | None = (
+        ResponseCache(get_default_cache_dir(), config.get('cache_ttl_days', 30)) if use_cache else None
+    )
 
     # Create individual diff chunks for each file to have more
     # precide response from the LLM and reduce the context size as well.
-    diff_chunks: list[str] = list(map(get_staged_diff, modified_files))
-    diff_chunks[:] = [x for x in diff_chunks if x]
-
-    # Make multiple calls for each file difference.
-    violations: list[Violation] = []
+    # The filenames are extracted from the chunks to keep only the files to check.
+    diff_chunks: list[str] = get_staged_diff_chunks()
+    files_to_check_chunks: list[str] = []
     for diff_chunk in diff_chunks:
-        llm_output = call_ollama_api(diff_chunk, config, ros_distro)
-        violations.extend(parse_llm_output(llm_output))
+        chunk_filepath: str = get_diff_chunk_filepath(diff_chunk)
+        if not chunk_filepath:
+            # Never let a diff that could not be understood pass as a clean review.
+            print(f'Warning: could not find the file path of the diff chunk:\n{diff_chunk[:200]}', file=sys.stderr)
+        elif _EXTENSIONS_TO_CHECK_RE.search(chunk_filepath):
+            files_to_check_chunks.append(diff_chunk)
+    diff_chunks[:] = files_to_check_chunks
+
+    # Identical changes made to different files are reviewed only once.
+    diff_chunk_keys: list[str] = [get_diff_chunk_key(x) for x in diff_chunks]
+    unique_diff_chunks: dict[str, str] = {}
+    for key, diff_chunk in zip(diff_chunk_keys, diff_chunks):
+        unique_diff_chunks.setdefault(key, diff_chunk)
+
+    # Make multiple concurrent calls, one for each unique file difference.
+    # The system prompt is the same for every call, so build it only once.
+    system_message: dict[str, str] = {'role': 'system', 'content': get_general_expert_prompt()}
+    results = asyncio.run(review_diff_chunks(list(unique_diff_chunks.values()), config, system_message, cache))
+    reviews: dict[str, list[Violation]] = {}
+    for (key, diff_chunk), result in zip(unique_diff_chunks.items(), results):
+        if isinstance(result, BaseException):
+            filepath: str = get_diff_chunk_filepath(diff_chunk)
+            # Both json decoding and pydantic validation errors are ValueErrors.
+            if isinstance(result, ValueError):
+                print(f'Error parsing the LLM review of {filepath}: {result}', file=sys.stderr)
+            else:
+                print(f'Error getting the review of {filepath} from the Ollama API: {result}', file=sys.stderr)
+            sys.exit(1)
+        reviews[key] = result
+
+    # Replay the review of the duplicated changes on each of their files.
+    violations: list[Violation] = []
+    for key, diff_chunk in zip(diff_chunk_keys, diff_chunks):
+        reviewed_diff_chunk: str = unique_diff_chunks[key]
+        if reviewed_diff_chunk is diff_chunk:
+            violations.extend(reviews[key])
+        else:
+            violations.extend(
+                relocate_violations(
+                    reviews[key], get_diff_chunk_filepath(reviewed_diff_chunk), get_diff_chunk_filepath(diff_chunk)
+                )
+            )
 
     print(f'\n--- LLM generated review. Found {len(violations)} violations. ---', file=sys.stderr)
     if violations:
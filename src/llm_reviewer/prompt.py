@@ -1,5 +1,7 @@
 """Hold prompts and useful constants."""
 
+import functools
+
 
 class Tokens:
     """Class to hold general tokens used in the prompts and violations."""
@@ -13,10 +15,11 @@ class Tokens:
     FROM_FILE_B_TOKEN: str = 'b_filepath'
 
 
+@functools.lru_cache(maxsize=1)
 def _get_violations_format_str() -> str:
     """Return the final part of the request which sets the violations output format."""
     return f"""Answer **only** with a json formatted string with a full list of violations.
-When there are no violations, return an empty string in json format.
+When there are no violations, return an empty json list.
 Each violation needs to have the following keys:
     "{Tokens.ORIGINAL_CODE_TOKEN}": "<original code block>",
     "{Tokens.PROPOSED_CODE_TOKEN}": "<proposed code block>",
@@ -28,6 +31,7 @@ Each violation needs to have the following keys:
 """
 
 
+@functools.lru_cache(maxsize=1)
 def get_general_expert_prompt() -> str:
     """Return the sytem promopt for a general software engineer."""
     return f"""You are an expert C++ and Python software engineer.
@@ -1,15 +1,16 @@
 """Violation dataclass."""
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
-@dataclass(repr=False)
+@dataclass(repr=False, slots=True)
 class Violation:
     """Violation dataclass that represents the result of the LLM review."""
 
     original_code: str
     proposed_code: str
-    diff: str
+    # Optional, it is generated from the code blocks when the LLM does not provide it.
+    diff: str = field(default='', kw_only=True)
     explanation: str
     suggestion: str
     a_filepath: str
@@ -17,7 +18,7 @@ class Violation:
 
     def __repr__(self) -> str:
         """Return a string representation of the violation."""
-        as_str: str = (
+        return (
             f'Explanation: {self.explanation}\n'
             f'Suggestion: {self.suggestion}\n'
             f'Original code:\n{self.original_code}\n'
@@ -26,4 +27,3 @@ class Violation:
             f'a_filepath: {self.a_filepath}\n'
             f'b_filepath: {self.b_filepath}\n'
         )
-        return as_str